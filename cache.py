@@ -0,0 +1,291 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import random
+import tempfile
+import types
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from tqdm.auto import tqdm
+
+try:
+    from .fixes import (NormalizeKabutes, other_fixes, DeleteSpaceBeforePunctuation, AddSpaceAfterPoint,
+                        AddSpaceBefore_m_d)
+    from .filters import my_filter
+    from .mistake_generator import generate_mistakes
+    from .typos import Typo
+except ImportError:
+    from fixes import (NormalizeKabutes, other_fixes, DeleteSpaceBeforePunctuation, AddSpaceAfterPoint,
+                       AddSpaceBefore_m_d)
+    from filters import my_filter
+    from mistake_generator import generate_mistakes
+    from typos import Typo
+
+logger = logging.getLogger(__name__)
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def doc_seed(seed, key):
+    return int(hashlib.sha1(f'{seed}-{key}'.encode('utf-8')).hexdigest()[:8], 16)
+
+
+def _source(obj):
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        return getattr(obj, '__qualname__', repr(obj))
+
+
+def called_modules(func):
+    # modules of the global names func refers to (e.g. my_filter -> filters), so that a lambda in a notebook
+    # picks up edits of filters.py but not edits of the notebook itself
+    own = inspect.getmodule(func)
+    modules = set()
+    if own is not None and own.__name__ != '__main__' and func.__name__ != '<lambda>':
+        modules.add(own)
+    codes, names = [getattr(func, '__code__', None)], set()
+    while codes:
+        code = codes.pop()
+        if code is None:
+            continue
+        names.update(code.co_names)
+        codes += [c for c in code.co_consts if isinstance(c, types.CodeType)]
+    for name in names:
+        obj = getattr(func, '__globals__', {}).get(name)
+        module = obj if isinstance(obj, types.ModuleType) else inspect.getmodule(obj) if obj is not None else None
+        if module is not None and module is not own and getattr(module, '__file__', None):
+            modules.add(module)
+    return modules
+
+
+def code_version(func, deps=None):
+    """
+    Hash of the source of func and of the modules it depends on. deps (modules, or functions/classes whose modules
+    are taken) overrides the modules found by called_modules.
+    """
+    if deps is None:
+        modules = called_modules(func)
+    else:
+        modules = {d if isinstance(d, types.ModuleType) else inspect.getmodule(d) for d in deps}
+    sources = [_source(func)] + sorted(_source(m) for m in modules if m is not None)
+    return hashlib.sha1('\n'.join(sources).encode('utf-8')).hexdigest()
+
+
+class StageCache:
+    """
+    On-disk cache of per-document stage outputs.
+
+    Key is (document content hash, stage name, hash of stage config and code version). The code version covers
+    the source of the stage function and of the modules it calls (see called_modules), or the modules given in deps.
+    Pass deps explicitly when a stage reaches library code indirectly, e.g. through a helper of the driver script.
+
+    Values are stored append-only: every run writes new entries of a shard as a new segment file
+    cache_dir/<stage>/<config hash>/<shard>/<segment>.pickle, so concurrent processes never overwrite each other
+    (at worst they compute the same document twice). The least recently used segments are deleted once the cache
+    grows over max_bytes. Document which a stage drops (e.g. my_filter) is cached as None.
+
+    Config is passed to func as keyword arguments, so it is exactly what the stage depends on.
+
+    Usage:
+        cache = StageCache('stage_cache')
+        sr = cache.run('fixes', do_fixes, df['text'])
+        sr = cache.run('filter', filter_text, sr, config=dict(min_characters=20))
+        print(cache.stats())
+    or the whole flow of the notebook with preprocess(df['text'], cache).
+
+    Random stages (corruption) must be run with stochastic=True and a 'seed' in config. Such func is then called
+    document by document with random and np.random seeded from (seed, document hash, copy number), so a sample
+    depends only on the document and the seed, never on what else was cached. Identical documents get their own
+    samples, a rerun with the same seed returns the cached samples and a new seed draws new ones.
+    Side effects of func (e.g. typo statistics) happen only for documents which were not cached.
+    Cross-document stages (drop_duplicates) are cheap and should be run outside the cache.
+    """
+    def __init__(self, cache_dir='stage_cache', max_bytes=2**34, n_shards=64):
+        self.cache_dir, self.max_bytes, self.n_shards = Path(cache_dir), max_bytes, n_shards
+        self.hits, self.misses = defaultdict(int), defaultdict(int)
+
+    def config_hash(self, func, config=None, deps=None):
+        try:
+            config = json.dumps(config, sort_keys=True)
+        except TypeError as e:
+            raise ValueError(f'Stage config must be JSON serialisable, got {config!r}') from e
+        return hashlib.sha1((config + code_version(func, deps=deps)).encode('utf-8')).hexdigest()[:16]
+
+    def shard_of(self, key):
+        return int(key[:8], 16) % self.n_shards
+
+    def keys_of(self, series, stochastic=False):
+        keys, seen = [], defaultdict(int)
+        for pos, text in enumerate(series.values):
+            if not isinstance(text, str):
+                raise ValueError(f'Expected text at position {pos}, got {text!r}. Drop missing texts first.')
+            key = text_hash(text)
+            if stochastic:
+                # n-th copy of the same document gets its own sample
+                seen[key] += 1
+                key = f'{key}-{seen[key]}'
+            keys.append(key)
+        return keys
+
+    def _load(self, shard_dir):
+        shard = {}
+        for path in sorted(shard_dir.glob('*.pickle')):
+            try:
+                with open(path, 'rb') as f:
+                    shard.update(pickle.load(f))
+                os.utime(path)  # mtime marks recent use for eviction
+            except FileNotFoundError:  # evicted by another process
+                continue
+        return shard
+
+    def _dump(self, shard_dir, entries):
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=shard_dir, suffix='.tmp', delete=False) as f:
+            pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, f.name[:-len('.tmp')] + '.pickle')
+
+    def run(self, name, func, series, config=None, deps=None, stochastic=False):
+        """
+        Applies func(series, **config) (series -> series, rows may be dropped) only to the documents of series which
+        are not cached for this stage, config and code version. Returns series with the same index, dropped rows
+        removed.
+        """
+        if stochastic and 'seed' not in (config or {}):
+            raise ValueError(f'Stochastic stage {name} needs a seed in its config')
+        config = config or {}
+        stage_dir = self.cache_dir / name / self.config_hash(func, config=config, deps=deps)
+        keys = self.keys_of(series, stochastic=stochastic)
+        outputs, missing = [None] * len(keys), []
+
+        by_shard = defaultdict(list)
+        for pos, key in enumerate(keys):
+            by_shard[self.shard_of(key)].append(pos)
+        for shard_id, positions in by_shard.items():
+            shard = self._load(stage_dir / f'{shard_id:03d}')
+            for pos in positions:
+                if keys[pos] in shard:
+                    outputs[pos] = shard[keys[pos]]
+                else:
+                    missing.append(pos)
+            del shard
+
+        n_hit = len(keys) - len(missing)
+        self.hits[name] += n_hit
+        self.misses[name] += len(missing)
+        logger.info(f'Stage {name}: {n_hit} cached, {len(missing)} to compute')
+
+        if missing:
+            missing.sort()
+            # identical documents need to be computed only once
+            todo = list({keys[pos]: pos for pos in reversed(missing)}.values())
+            new = dict.fromkeys(keys[pos] for pos in todo)
+            if stochastic:
+                for pos in tqdm(todo, desc=name):
+                    seed = doc_seed(config['seed'], keys[pos])
+                    random.seed(seed)
+                    np.random.seed(seed)
+                    computed = func(pd.Series(series.values[[pos]], name=series.name), **config)
+                    new[keys[pos]] = computed.iloc[0] if len(computed) else None
+            else:
+                computed = func(pd.Series(series.values[todo], name=series.name), **config)
+                for i, value in computed.items():
+                    new[keys[todo[i]]] = value
+            for pos in missing:
+                outputs[pos] = new[keys[pos]]
+            segments = defaultdict(dict)
+            for key, value in new.items():
+                segments[self.shard_of(key)][key] = value
+            for shard_id, entries in segments.items():
+                self._dump(stage_dir / f'{shard_id:03d}', entries)
+            self.evict()
+
+        keep = [pos for pos, value in enumerate(outputs) if value is not None]
+        return pd.Series([outputs[pos] for pos in keep], index=series.index[keep], dtype=object, name=series.name)
+
+    def evict(self):
+        files = []
+        for path in self.cache_dir.rglob('*.pickle'):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            logger.info(f'Evicted {path}')
+
+    def stats(self):
+        df = pd.DataFrame({'hits': pd.Series(self.hits, dtype=int), 'misses': pd.Series(self.misses, dtype=int)})
+        df = df.fillna(0).astype(int)
+        df['hit_rate'] = df['hits'] / (df['hits'] + df['misses']).clip(lower=1)
+        return df
+
+
+def _fix(series):
+    series = other_fixes(series.str.normalize("NFKC"))
+    for class_ in [NormalizeKabutes, AddSpaceBefore_m_d, AddSpaceAfterPoint, DeleteSpaceBeforePunctuation]:
+        series = class_().replace(series)
+    return series
+
+
+def filter_text(series, **kwargs):
+    return my_filter(series.to_frame('text'), **kwargs)['text']
+
+
+def _chunk(series, n_max):
+    return series.apply(lambda x: [x[i:i + n_max] for i in range(0, len(x), n_max)])
+
+
+TYPO_FILES = {'github': ['github_init_stats_qwerty.pickle', 'github-typo-corpus.v1.0.0.jsonl'],
+              'twitter': ['typo-corpus-r1.txt']}
+_typos = {}
+
+
+def typo_files(typo_corpus):
+    # size and mtime of the statistics files Typo reads, so that replacing them invalidates cached corruptions
+    if typo_corpus is None:
+        return None
+    return {name: [os.stat(name).st_size, os.stat(name).st_mtime] for name in TYPO_FILES[typo_corpus]
+            if Path(name).exists()}
+
+
+def _corrupt(series, frac, seed, typo_corpus, typo_files=None):
+    # seeding is done per document by StageCache.run, Typo is built by preprocess
+    series = generate_mistakes(series, frac=frac, progress=False)
+    if typo_corpus is not None:
+        series = series.apply(_typos[typo_corpus, frac].generate_errors)
+    return series
+
+
+def preprocess(series, cache, n_max=700, frac=0.02, seed=0, typo_corpus=None, filter_kwargs=None):
+    """
+    The preprocessing flow of the notebook (fixes, my_filter, dedup, chunking, corruption) run through cache.
+    Returns dataframe with 'text' and 'corrupted' columns.
+    """
+    filter_kwargs = {**dict(min_characters=20, min_lithuanian_fraction=0.98, min_fraction_of_spaces_to_non_spaces=0.02),
+                     **(filter_kwargs or {})}
+    series = cache.run('fixes', _fix, series, deps=[other_fixes])
+    series = cache.run('filter', filter_text, series, config=filter_kwargs, deps=[my_filter])
+    series = series.drop_duplicates()
+    series = cache.run('chunk', _chunk, series, config=dict(n_max=n_max), deps=[])
+    series = series.explode().dropna().reset_index(drop=True)  # empty text has no chunks
+    if typo_corpus is not None and (typo_corpus, frac) not in _typos:
+        # takes very long the first time, and Typo reseeds random, so it is built once before any document is seeded
+        _typos[typo_corpus, frac] = Typo(corpus=typo_corpus, weight=frac * 100, seed=seed)
+    config = dict(frac=frac, seed=seed, typo_corpus=typo_corpus, typo_files=typo_files(typo_corpus))
+    corrupted = cache.run('corrupt', _corrupt, series, config=config,
+                          deps=[generate_mistakes, Typo], stochastic=True)
+    return pd.DataFrame({'text': series, 'corrupted': corrupted})
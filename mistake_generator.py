@@ -99,11 +99,12 @@ def ff(original_, values_, weights_):
     return output
 
 
-def generate_mistakes(series, frac):
-    for i in tqdm([Suduslejimas(frac=frac), Suskardejimas(frac=frac), Geminata2(frac=frac), Geminata(frac=frac)]):
+def generate_mistakes(series, frac, progress=True):
+    mistakes = [Suduslejimas(frac=frac), Suskardejimas(frac=frac), Geminata2(frac=frac), Geminata(frac=frac)]
+    for i in tqdm(mistakes, disable=not progress):
         series = i.corrupt(series)
     series = swapcase(series, frac=frac)
-    for pat, values, weights in tqdm(GROUPS):
+    for pat, values, weights in tqdm(GROUPS, disable=not progress):
         series = series.str.replace(pat=pat, regex=True, flags=re.IGNORECASE,
                                     repl=lambda x: x.group(0) if (random() > frac) else ff(x[0], values, weights))
     series = add_delete_spaces(series, frac=frac)
@@ -0,0 +1,116 @@
+import os
+
+import pandas as pd
+import pytest
+
+from cache import StageCache, called_modules, code_version, preprocess, filter_text, _chunk, _corrupt
+import filters
+
+TEXTS = ['Labas.Kaip sekasi , drauge? Viskas gerai.', 'x', 'Labas.Kaip sekasi , drauge? Viskas gerai.',
+         'Šiandien 25d. lijo ir buvo šalta.']
+
+
+def upper(series, suffix=''):
+    return series.str.upper() + suffix
+
+
+def test_hits_misses_and_config_change(tmp_path):
+    cache = StageCache(tmp_path)
+    series = pd.Series(TEXTS)
+    first = cache.run('upper', upper, series)
+    second = cache.run('upper', upper, series)
+    pd.testing.assert_series_equal(first, second)
+    assert cache.stats().loc['upper', 'hits'] == 4
+    assert cache.stats().loc['upper', 'misses'] == 4
+
+    changed = cache.run('upper', upper, series, config=dict(suffix='!'))
+    assert changed.str.endswith('!').all()
+    assert cache.stats().loc['upper', 'misses'] == 8
+    # key order of config does not matter
+    assert cache.config_hash(upper, dict(a=1, b=2)) == cache.config_hash(upper, dict(b=2, a=1))
+    with pytest.raises(ValueError):
+        cache.config_hash(upper, dict(obj=object()))
+
+
+def test_dropped_rows_are_cached(tmp_path):
+    series = pd.Series(TEXTS, index=[0, 0, 1, 1])  # non unique index, e.g. after pd.concat
+    for _ in range(2):
+        cache = StageCache(tmp_path)
+        kept = cache.run('filter', filter_text, series, config=dict(min_characters=20))
+        assert list(kept.index) == [0, 1, 1]
+    assert cache.stats().loc['filter', 'hit_rate'] == 1.0
+
+
+def test_missing_text_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        StageCache(tmp_path).run('upper', upper, pd.Series(['a', None]))
+
+
+def test_stochastic_stage_keeps_duplicates_apart(tmp_path):
+    cache = StageCache(tmp_path)
+    calls = []
+
+    def count(series, seed):
+        calls.append(len(series))
+        return series
+
+    with pytest.raises(ValueError):
+        cache.run('count', count, pd.Series(['a', 'a']), config={}, stochastic=True)
+    cache.run('count', count, pd.Series(['a', 'a']), config=dict(seed=0), stochastic=True)
+    cache.run('count', count, pd.Series(['a', 'a']), config=dict(seed=0), stochastic=True)
+    cache.run('count', count, pd.Series(['a', 'a']), config=dict(seed=1), stochastic=True)
+    # random stages are computed document by document
+    assert calls == [1, 1, 1, 1]
+
+
+def test_code_version_follows_called_modules():
+    assert called_modules(lambda s: filters.my_filter(s)) == {filters}
+    assert called_modules(lambda s: filter_text(s)) != called_modules(lambda s: s)
+    assert code_version(lambda s: s, deps=[filters]) != code_version(lambda s: s, deps=[])
+
+
+def test_evict_removes_least_recently_used(tmp_path):
+    cache = StageCache(tmp_path, max_bytes=10**9)
+    cache.run('old', upper, pd.Series(TEXTS))
+    cache.run('new', upper, pd.Series(TEXTS))
+    old = list((tmp_path / 'old').rglob('*.pickle'))
+    new = list((tmp_path / 'new').rglob('*.pickle'))
+    for path in old:
+        os.utime(path, (0, 0))
+    cache.max_bytes = sum(p.stat().st_size for p in new)
+    cache.evict()
+    assert not any(p.exists() for p in old)
+    assert all(p.exists() for p in new)
+
+
+def test_preprocess(tmp_path):
+    series = pd.Series(TEXTS)
+    df = preprocess(series, StageCache(tmp_path), n_max=10)
+    cache = StageCache(tmp_path)
+    pd.testing.assert_frame_equal(df, preprocess(series, cache, n_max=10))
+    assert (cache.stats()['hit_rate'] == 1.0).all()
+    assert df['text'].str.len().max() <= 10
+
+
+def test_corruption_does_not_depend_on_cache_history(tmp_path):
+    a = pd.Series(TEXTS)
+    b = pd.Series(TEXTS + ['Rytoj 10 val. vyks susirinkimas mokykloje.'])
+    preprocess(a, StageCache(tmp_path / 'warm'), frac=0.3)
+    warm = preprocess(b, StageCache(tmp_path / 'warm'), frac=0.3)
+    cold = preprocess(b, StageCache(tmp_path / 'cold'), frac=0.3)
+    pd.testing.assert_frame_equal(warm, cold)
+    other_seed = preprocess(b, StageCache(tmp_path / 'cold'), frac=0.3, seed=1)
+    assert not other_seed['corrupted'].equals(cold['corrupted'])
+
+
+def test_empty_text_has_no_chunks(tmp_path):
+    cache = StageCache(tmp_path)
+    series = cache.run('chunk', _chunk, pd.Series(['', TEXTS[0]]), config=dict(n_max=10), deps=[])
+    series = series.explode().dropna().reset_index(drop=True)
+    assert len(cache.run('corrupt', _corrupt, series, config=dict(frac=0.3, seed=0, typo_corpus=None),
+                         stochastic=True)) == 5
+
+
+def test_preprocess_filter_kwargs_override_defaults(tmp_path):
+    df = preprocess(pd.Series(TEXTS), StageCache(tmp_path), filter_kwargs=dict(min_characters=40))
+    assert df['text'].tolist() == ['Labas. Kaip sekasi, drauge? Viskas gerai.']